@@ -0,0 +1,25 @@
+"""
+msgspec schema for streamed chat frames. Kept out of stream_utils because
+mypyc can't compile msgspec.Struct classes; this module always stays Python.
+"""
+import msgspec
+
+
+class Delta(msgspec.Struct):
+  role: str | None = None
+  content: str | None = None
+
+
+class Choice(msgspec.Struct):
+  delta: Delta | None = None
+  message: Delta | None = None
+
+
+class Chunk(msgspec.Struct):
+  """One streamed frame: OpenAI-style `choices`, or a bare `response`/`text`."""
+  choices: list[Choice] = msgspec.field(default_factory=list)
+  response: str | None = None
+  text: str | None = None
+
+
+chunk_decoder = msgspec.json.Decoder(Chunk)
@@ -0,0 +1,30 @@
+"""
+Hot-path helpers for the chat stream, kept free of Streamlit so they can be
+compiled with mypyc into `stream_utils_compiled` (see README). The app falls
+back to this plain module when no working build is present.
+"""
+import msgspec
+
+from stream_schema import Delta, chunk_decoder
+
+
+def _is_empty(delta: Delta | None) -> bool:
+  # Mirrors an empty/missing dict: Structs are always truthy, so check the fields
+  return delta is None or (delta.role is None and delta.content is None)
+
+
+def parse_sse_data(data: str) -> str:
+  """Return the text carried by one SSE `data:` payload ("" if there is none)."""
+  # Only JSON objects carry text; skip keepalives and other frames without raising.
+  # httpx-sse strips just one space after "data:", so allow extra leading whitespace
+  if data[:1] != "{" and data.lstrip()[:1] != "{":
+    return ""
+  try:
+    chunk = chunk_decoder.decode(data)
+  except msgspec.DecodeError:
+    return ""
+  if chunk.choices:
+    choice = chunk.choices[0]
+    delta = choice.message if _is_empty(choice.delta) else choice.delta
+    return (delta.content if delta is not None else None) or ""
+  return chunk.response or chunk.text or ""
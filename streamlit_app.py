@@ -1,8 +1,25 @@
 import streamlit as st
-import requests, json
+import httpx
+from httpx_sse import connect_sse
+import orjson
+import ijson
 from datetime import datetime
 import databricks.sql
+try:
+  # Optional mypyc build of stream_utils (see README); any failure falls back to pure Python
+  from stream_utils_compiled import parse_sse_data
+except ModuleNotFoundError:
+  from stream_utils import parse_sse_data
+except Exception as e:
+  print(f"⚠️ Ignoring broken stream_utils_compiled build: {e}")
+  from stream_utils import parse_sse_data
+import socket
 import threading
+import hashlib
+from collections import OrderedDict, deque
+import queue
+import time
+import uuid
 
 st.set_page_config(page_title="Field Staff Chatbot")
 st.title("Field Staff Chatbot 4")
@@ -67,147 +84,350 @@ ROBOT_HTML = '''
 '''
 st.markdown(TYPING_CSS, unsafe_allow_html=True)
 
+# Feedback rows are written as one multi-row INSERT of up to this many rows
+FEEDBACK_BATCH_SIZE = 100
+# Rows waiting beyond this are dropped rather than piling up behind a slow endpoint
+FEEDBACK_QUEUE_MAX = 1000
+
+# Chat history is a bounded deque of (role, content) tuples; role indexes ROLES
+ROLES = ("user", "assistant")
+USER, ASSISTANT = 0, 1
+MAX_MESSAGES = 50
+# Earlier messages sent to the endpoint with each new question (last 6 exchanges)
+CONTEXT_WINDOW = 12
+# Chat histories kept in the process-wide store; the least recently used is dropped beyond this
+MAX_STORED_SESSIONS = 500
+
+# session_state keys holding per-message UI state (suffixed with the message id)
+MESSAGE_KEY_PREFIXES = ("feedback_", "rate_", "thumbs_up_", "thumbs_down_", "category_", "comment_")
+
+# Answers to repeated opening questions are reused for this long, up to this many entries
+ANSWER_CACHE_TTL_S = 3600
+ANSWER_CACHE_MAX = 500
+
+# Only the most recent messages are rendered unless the user asks for more
+HISTORY_WINDOW = 10
+
+# Streamed tokens are buffered and flushed to the UI in batches (size or time)
+FLUSH_BYTES = 8192
+FLUSH_INTERVAL_S = 0.025
+
 # -----------------------------
 # Session state
 # -----------------------------
-if "messages" not in st.session_state:
-  st.session_state.messages = []
+@st.cache_resource
+def session_store():
+  """Process-wide chat histories keyed by session id (LRU order), held by reference across reruns."""
+  return threading.Lock(), OrderedDict()
+
+def get_chat_session(sid):
+  """Return (session, created); created is True when the history had to be (re)built empty."""
+  lock, sessions = session_store()
+  with lock:
+    session = sessions.get(sid)
+    if session is not None:
+      sessions.move_to_end(sid)
+      return session, False
+    if len(sessions) >= MAX_STORED_SESSIONS:
+      sessions.popitem(last=False)
+    # "evicted" counts messages dropped off the deque; keeps widget keys stable per message
+    session = sessions[sid] = {"messages": deque(maxlen=MAX_MESSAGES), "evicted": 0}
+    return session, True
+
+# Server-generated so no two browser tabs can end up sharing one history
+if "session_id" not in st.session_state:
+  st.session_state.session_id = uuid.uuid4().hex
 if "pending_feedback" not in st.session_state:
   st.session_state.pending_feedback = None
 
+chat_session, fresh_history = get_chat_session(st.session_state.session_id)
+messages = chat_session["messages"]
+
+if fresh_history:
+  # Message ids restart at 0, so feedback state left from an evicted history must not carry over
+  for key in [k for k in st.session_state if k.startswith(MESSAGE_KEY_PREFIXES)]:
+    del st.session_state[key]
+  st.session_state.pending_feedback = None
+
+def add_message(role, content):
+  lock, _ = session_store()
+  with lock:
+    if len(messages) == messages.maxlen:
+      chat_session["evicted"] += 1
+    messages.append((role, content))
+
 # -----------------------------
 # Feedback writer (background)
 # -----------------------------
+@st.cache_resource
+def get_databricks_conn():
+  """One shared SQL connection per server process (avoids a TLS + auth round-trip per click)."""
+  return databricks.sql.connect(
+    server_hostname=st.secrets["DATABRICKS_SERVER_HOSTNAME"],
+    http_path=st.secrets["DATABRICKS_HTTP_PATH"],
+    access_token=st.secrets["DATABRICKS_PAT"]
+  )
+
+def write_feedback_batch(rows):
+  # One statement for the whole batch (executemany would run one INSERT per row),
+  # so a retry after a stale connection can't re-insert rows that already landed
+  values = ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * len(rows))
+  params = [value for row in rows for value in row]
+  for attempt in range(2):
+    try:
+      conn = get_databricks_conn()
+      with conn.cursor() as cursor:
+        cursor.execute(f"""
+          INSERT INTO ai_squad_np.default.feedback
+          (question, answer, score, comment, timestamp, category, user)
+          VALUES {values}
+        """, params)
+      return
+    except databricks.sql.exc.OperationalError as e:
+      # Cached connection went stale; drop it and reconnect once
+      get_databricks_conn.clear()
+      if attempt:
+        print(f"⚠️ Could not store {len(rows)} feedback row(s): {e}")
+    except Exception as e:
+      print(f"⚠️ Could not store {len(rows)} feedback row(s): {e}")
+      return
+
+def feedback_worker(q):
+  """Drain the queue forever, coalescing whatever is waiting into one batch."""
+  while True:
+    batch = [q.get()]
+    while len(batch) < FEEDBACK_BATCH_SIZE and not q.empty():
+      batch.append(q.get_nowait())
+    write_feedback_batch(batch)
+
+@st.cache_resource
+def get_feedback_queue():
+  """Process-wide feedback queue with its single daemon flusher (survives reruns)."""
+  q = queue.Queue(maxsize=FEEDBACK_QUEUE_MAX)
+  threading.Thread(target=feedback_worker, args=(q,), daemon=True).start()
+  return q
+
 def store_feedback(question, answer, score, comment, category):
+  """Non-blocking: enqueue the row for the background flusher. Returns False if it was dropped."""
   try:
-    conn = databricks.sql.connect(
-      server_hostname=st.secrets["DATABRICKS_SERVER_HOSTNAME"],
-      http_path=st.secrets["DATABRICKS_HTTP_PATH"],
-      access_token=st.secrets["DATABRICKS_PAT"]
-    )
-    cursor = conn.cursor()
-    cursor.execute("""
-      INSERT INTO ai_squad_np.default.feedback
-      (question, answer, score, comment, timestamp, category, user)
-      VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (
+    get_feedback_queue().put_nowait((
       question, answer, score, comment,
       datetime.now().isoformat(), category, ""
     ))
-    cursor.close()
-    conn.close()
-  except Exception as e:
-    print(f"⚠️ Could not store feedback: {e}")
+    return True
+  except queue.Full:
+    print("⚠️ Feedback queue full; dropping feedback row.")
+    return False
 
 # -----------------------------
 # Streaming helper
 # -----------------------------
-def stream_databricks_chat(messages):
+@st.cache_resource
+def get_http_client():
+  """Process-wide HTTP/2 client so chat turns reuse one warm, multiplexed connection."""
+  transport = httpx.HTTPTransport(
+    http2=True,
+    # Bigger kernel receive buffer so fast token streams need fewer recv() wakeups
+    socket_options=[(socket.SOL_SOCKET, socket.SO_RCVBUF, 256 * 1024)],
+  )
+  return httpx.Client(transport=transport, timeout=300.0)
+
+# Where a plain (non-SSE) JSON reply keeps its text
+JSON_CONTENT_PATHS = {"choices.item.message.content", "response", "text"}
+
+def iter_json_content(byte_chunks):
+  """Incrementally parse a non-SSE JSON body, yielding content strings as soon as each one completes."""
+  events = ijson.sendable_list()
+  parser = ijson.parse_coro(events)
+  for chunk in byte_chunks:
+    parser.send(chunk)
+    for prefix, event, value in events:
+      if event == "string" and value and prefix in JSON_CONTENT_PATHS:
+        yield value
+    del events[:]
+  parser.close()
+
+def stream_databricks_chat(messages, status=None):
   """
   Yields text chunks from a Databricks chat endpoint that supports SSE ('data:' lines).
   Compatible with OpenAI-style /v1/chat/completions stream responses.
+  If given, status["error"] is set to True when the stream ends on a connection/parse error.
   """
   url = st.secrets["ENDPOINT_URL"]
   headers = {
     "Authorization": f"Bearer {st.secrets['DATABRICKS_PAT']}",
     "Content-Type": "application/json",
-    "Accept": "text/event-stream",
-    "Connection": "keep-alive",
-  }
-  payload = {"messages": messages, "stream": True}
+  }  # connect_sse adds the text/event-stream Accept header
+  # The new question is already the last message, so take one more than the window
+  window = list(messages)[-(CONTEXT_WINDOW + 1):]
+  if window and window[0][0] != USER:
+    window = window[1:]  # keep the window starting on a user turn
+  payload = orjson.dumps({
+    "messages": [{"role": ROLES[role], "content": content} for role, content in window],
+    "stream": True,
+  })
 
   try:
-    with requests.post(url, headers=headers, json=payload, stream=True, timeout=300) as r:
+    with connect_sse(get_http_client(), "POST", url, headers=headers, content=payload) as event_source:
+      r = event_source.response
       r.raise_for_status()
-      for raw_line in r.iter_lines(decode_unicode=True):
-        if not raw_line:
-          continue
-        data = raw_line[len("data: "):].strip() if raw_line.startswith("data: ") else raw_line.strip()
-        if data == "[DONE]":
+      if not r.headers.get("content-type", "").startswith("text/event-stream"):
+        yield from iter_json_content(r.iter_bytes())
+        return
+      for event in event_source.iter_sse():
+        if event.data == "[DONE]":
           break
-        try:
-          obj = json.loads(data)
-        except json.JSONDecodeError:
-          continue
-        try:
-          delta = obj["choices"][0].get("delta") or obj["choices"][0].get("message") or {}
-          piece = delta.get("content") or ""
-          if piece:
-            yield piece
-        except Exception:
-          piece = obj.get("response") or obj.get("text") or ""
-          if piece:
-            yield piece
-  except requests.exceptions.RequestException as e:
+        piece = parse_sse_data(event.data)
+        if piece:
+          yield piece
+  except httpx.HTTPError as e:
+    if status is not None:
+      status["error"] = True
     yield f"\n\n❌ Connection error while streaming: {e}"
+  except ijson.JSONError as e:
+    if status is not None:
+      status["error"] = True
+    yield f"\n\n❌ Could not parse endpoint response: {e}"
+
+def batch_tokens(tokens):
+  """Join tokens into one chunk per FLUSH_INTERVAL_S or FLUSH_BYTES, so the UI re-renders per batch."""
+  pending = []
+  pending_bytes = 0
+  last_flush = time.monotonic()
+  for token in tokens:
+    pending.append(token)
+    pending_bytes += len(token)
+    if pending_bytes >= FLUSH_BYTES or time.monotonic() - last_flush >= FLUSH_INTERVAL_S:
+      yield "".join(pending)
+      pending = []
+      pending_bytes = 0
+      last_flush = time.monotonic()
+  if pending:
+    yield "".join(pending)
+
+# -----------------------------
+# Repeat-question cache
+# -----------------------------
+def question_key(question):
+  return hashlib.sha256(" ".join(question.lower().split()).encode("utf-8")).hexdigest()
+
+@st.cache_resource
+def answer_cache():
+  """Process-wide question key -> (expires_at, reply), in LRU order."""
+  return threading.Lock(), OrderedDict()
+
+def get_cached_answer(key):
+  lock, entries = answer_cache()
+  with lock:
+    entry = entries.get(key)
+    if entry is None:
+      return None
+    expires_at, answer = entry
+    if expires_at < time.monotonic():
+      del entries[key]
+      return None
+    entries.move_to_end(key)
+    return answer
+
+def put_cached_answer(key, answer):
+  lock, entries = answer_cache()
+  with lock:
+    entries[key] = (time.monotonic() + ANSWER_CACHE_TTL_S, answer)
+    entries.move_to_end(key)
+    while len(entries) > ANSWER_CACHE_MAX:
+      entries.popitem(last=False)
+
+# -----------------------------
+# Connection warm-up (once per server process, off the critical path)
+# -----------------------------
+def warm_connections(client, url):
+  try:
+    client.head(url)
+  except httpx.HTTPError:
+    pass
+  try:
+    get_databricks_conn()
+  except Exception as e:
+    print(f"⚠️ Could not pre-connect to Databricks SQL: {e}")
+
+@st.cache_resource
+def start_connection_warmup():
+  threading.Thread(
+    target=warm_connections,
+    args=(get_http_client(), st.secrets["ENDPOINT_URL"]),
+    daemon=True
+  ).start()
+  return True
+
+start_connection_warmup()
 
 # -----------------------------
 # Feedback renderers
 # -----------------------------
 def render_feedback_inline(idx: int):
   """Show feedback UI ONLY (no message content); call this right after streaming."""
-  msg = st.session_state.messages[idx]
-  if msg["role"] != "assistant":
+  role, answer = messages[idx]
+  if role != ASSISTANT:
     return
 
-  question_idx = idx - 1
-  question = (
-    st.session_state.messages[question_idx]["content"]
-    if question_idx >= 0 and st.session_state.messages[question_idx]["role"] == "user"
-    else ""
-  )
+  question = messages[idx - 1][1] if idx > 0 and messages[idx - 1][0] == USER else ""
 
-  feedback_key = f"feedback_{idx}"
+  # Absolute message id, so keys don't shift when old messages fall off the deque
+  msg_id = chat_session["evicted"] + idx
+  feedback_key = f"feedback_{msg_id}"
   feedback_status = st.session_state.get(feedback_key, "none")
 
+  # Only the newest answer builds its rating widgets up front; older ones wait for a toggle
+  is_latest = idx == len(messages) - 1
+  if feedback_status == "none" and not is_latest and not st.toggle("Rate this answer", key=f"rate_{msg_id}"):
+    return
+
   if feedback_status == "none":
     st.write("Was this answer helpful?")
     col1, col2 = st.columns(2)
-    if col1.button("👍 Yes", key=f"thumbs_up_{idx}"):
+    if col1.button("👍 Yes", key=f"thumbs_up_{msg_id}"):
       st.session_state[feedback_key] = "thumbs_up"
-      st.session_state.pending_feedback = idx
-    if col2.button("👎 No", key=f"thumbs_down_{idx}"):
+      st.session_state.pending_feedback = msg_id
+    if col2.button("👎 No", key=f"thumbs_down_{msg_id}"):
       st.session_state[feedback_key] = "thumbs_down"
-      st.session_state.pending_feedback = idx
+      st.session_state.pending_feedback = msg_id
 
-  if st.session_state.pending_feedback == idx:
+  if st.session_state.pending_feedback == msg_id:
     if st.session_state.get(feedback_key) == "thumbs_down":
-      with st.form(f"thumbs_down_form_{idx}"):
+      with st.form(f"thumbs_down_form_{msg_id}"):
         st.subheader("Sorry about that — how can we improve?")
         feedback_category = st.selectbox(
           "What type of issue best describes the problem?",
           ["inaccurate", "outdated", "too long", "too short", "other"],
-          key=f"category_{idx}"
+          key=f"category_{msg_id}"
         )
-        feedback_comment = st.text_area("What could be better?", key=f"comment_{idx}")
+        feedback_comment = st.text_area("What could be better?", key=f"comment_{msg_id}")
         if st.form_submit_button("Submit Feedback 👎"):
-          st.session_state.pending_feedback = None
-          st.toast("✅ Your feedback was recorded!")
-          threading.Thread(
-            target=store_feedback,
-            args=(question, msg["content"], "thumbs_down", feedback_comment, feedback_category),
-            daemon=True
-          ).start()
-          st.success("🎉 Thanks for your feedback!")
+          if store_feedback(question, answer, "thumbs_down", feedback_comment, feedback_category):
+            st.session_state.pending_feedback = None
+            st.toast("✅ Your feedback was recorded!")
+            st.success("🎉 Thanks for your feedback!")
+          else:
+            # Leave the form (and what was typed) up so it can simply be resubmitted
+            st.warning("⚠️ We're receiving a lot of feedback right now and couldn't save yours. Please press Submit again in a moment.")
     elif st.session_state.get(feedback_key) == "thumbs_up":
-      with st.form(f"thumbs_up_form_{idx}"):
-        feedback_comment = st.text_area("Please provide any additional thoughts (optional)", key=f"comment_{idx}")
+      with st.form(f"thumbs_up_form_{msg_id}"):
+        feedback_comment = st.text_area("Please provide any additional thoughts (optional)", key=f"comment_{msg_id}")
         if st.form_submit_button("Submit Feedback 👍"):
-          st.session_state.pending_feedback = None
-          st.toast("✅ Thanks for sharing more detail!")
-          threading.Thread(
-            target=store_feedback,
-            args=(question, msg["content"], "thumbs_up", feedback_comment, ""),
-            daemon=True
-          ).start()
-          st.success("🎉 Thanks for your feedback!")
+          if store_feedback(question, answer, "thumbs_up", feedback_comment, ""):
+            st.session_state.pending_feedback = None
+            st.toast("✅ Thanks for sharing more detail!")
+            st.success("🎉 Thanks for your feedback!")
+          else:
+            # Leave the form (and what was typed) up so it can simply be resubmitted
+            st.warning("⚠️ We're receiving a lot of feedback right now and couldn't save yours. Please press Submit again in a moment.")
 
 def render_message_with_feedback(idx: int):
   """Render a message and, if assistant, its feedback UI (used for history only)."""
-  msg = st.session_state.messages[idx]
-  with st.chat_message(msg["role"]):
-    st.markdown(msg["content"])
-    if msg["role"] == "assistant":
+  role, content = messages[idx]
+  with st.chat_message(ROLES[role]):
+    st.markdown(content)
+    if role == ASSISTANT:
       render_feedback_inline(idx)
 
 # -----------------------------
@@ -217,25 +437,29 @@ user_input = st.chat_input("Ask a question...")
 
 # Append new user input so it renders at the bottom right away
 if user_input:
-  st.session_state.messages.append({"role": "user", "content": user_input})
+  add_message(USER, user_input)
 
 # -----------------------------
 # Render history (everything except a *pending* last user)
 # -----------------------------
 pending_user = None
-messages_to_render = st.session_state.messages
+n_history = len(messages)
 
-if messages_to_render and messages_to_render[-1]["role"] == "user" and user_input:
-  pending_user = messages_to_render[-1]
-  messages_to_render = messages_to_render[:-1]
+if n_history and messages[-1][0] == USER and user_input:
+  pending_user = messages[-1][1]
+  n_history -= 1
 
-for i in range(len(messages_to_render)):
+first_shown = max(0, n_history - HISTORY_WINDOW)
+if first_shown and st.toggle("Show earlier messages", key="show_earlier_messages"):
+  first_shown = 0
+
+for i in range(first_shown, n_history):
   render_message_with_feedback(i)
 
 # Show the pending user message at the bottom
 if pending_user:
   with st.chat_message("user"):
-    st.markdown(pending_user["content"])
+    st.markdown(pending_user)
 
 # -----------------------------
 # Stream assistant at the bottom with the robot indicator:
@@ -243,22 +467,31 @@ if pending_user:
 #   - replace with tokens as they arrive (no blank bubble, no duplicates)
 # -----------------------------
 if pending_user:
+  # Only an opening question is context-free enough to answer from the cache
+  cache_key = question_key(pending_user) if n_history == 0 else None
+  cached = get_cached_answer(cache_key) if cache_key else None
+
   with st.chat_message("assistant"):
     bubble = st.empty()  # one placeholder for indicator -> streamed content
 
-    # Show the robot animation immediately
-    bubble.markdown(ROBOT_HTML, unsafe_allow_html=True)
+    if cached:
+      reply_text = cached
+    else:
+      # Show the robot animation immediately
+      bubble.markdown(ROBOT_HTML, unsafe_allow_html=True)
 
-    full_reply = []
-    for token in stream_databricks_chat(st.session_state.messages):
-      full_reply.append(token)
-      bubble.markdown("".join(full_reply))  # replaces robot on first token
+      # write_stream renders into the bubble, replacing the robot on the first token
+      stream_status = {"error": False}
+      streamed = bubble.write_stream(batch_tokens(stream_databricks_chat(messages, stream_status)))
+      streamed = (streamed if isinstance(streamed, str) else "").strip()
 
-    # Finalize content (if no tokens, still replace robot with fallback)
-    reply_text = "".join(full_reply).strip() or "⚠️ Model returned no content."
+      # Finalize content (if no tokens, still replace robot with fallback)
+      reply_text = streamed or "⚠️ Model returned no content."
+      if cache_key and streamed and not stream_status["error"]:
+        put_cached_answer(cache_key, reply_text)
     bubble.markdown(reply_text)
 
     # Persist + inline feedback (no duplicate re-render)
-    st.session_state.messages.append({"role": "assistant", "content": reply_text})
-    new_idx = len(st.session_state.messages) - 1
+    add_message(ASSISTANT, reply_text)
+    new_idx = len(messages) - 1
     render_feedback_inline(new_idx)